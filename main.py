@@ -1,11 +1,15 @@
 import os
+import queue
 import tempfile
+import time
 import uuid
 import threading
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, send_file
+from werkzeug.utils import secure_filename
 
 # --- Local Imports ---
-import PyPDF2
+from pdf_utils import extract_pdf_pages
 from translate import OfflineTranslator
 
 # --- Flask App Setup ---
@@ -13,7 +17,56 @@ app = Flask(__name__)
 
 # --- In-memory storage for task status (for demonstration) ---
 # In a real production app, you'd use a database or Redis for this.
+# Request threads and background threads share it, so every access holds
+# tasks_lock; completed/failed tasks are evicted TASK_TTL_SECONDS after finishing.
 tasks = {}
+tasks_lock = threading.Lock()
+TASK_TTL_SECONDS = 3600
+
+def create_task(task_id: str, **fields):
+    with tasks_lock:
+        tasks[task_id] = {'status': 'pending', 'created_at': time.time(), **fields}
+
+def update_task(task_id: str, **fields):
+    with tasks_lock:
+        if task_id in tasks:
+            tasks[task_id].update(fields)
+
+def get_task(task_id: str) -> dict | None:
+    with tasks_lock:
+        task = tasks.get(task_id)
+        return dict(task) if task else None
+
+def evict_expired_tasks():
+    """Janitor thread: drop tasks finished over TASK_TTL_SECONDS ago and their output files."""
+    # Files a download still had open when their task was evicted, retried each pass
+    undeleted_files = []
+    while True:
+        time.sleep(60)
+        # Any error is logged and retried next round; this thread must never die
+        try:
+            cutoff = time.time() - TASK_TTL_SECONDS
+            with tasks_lock:
+                # Pending and processing tasks are never evicted, however long they take
+                expired = [tid for tid, task in tasks.items() if task.get('finished_at', cutoff) < cutoff]
+                output_files = [tasks.pop(tid).get('output_file') for tid in expired]
+            output_files += undeleted_files
+            undeleted_files = []
+            for output_file in output_files:
+                if not output_file:
+                    continue
+                try:
+                    os.remove(output_file)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    # e.g. Windows refuses while a download still has the file open
+                    print(f"Could not remove {output_file}, will retry: {e}")
+                    undeleted_files.append(output_file)
+        except Exception as e:
+            print(f"Error evicting expired tasks: {e}")
+
+threading.Thread(target=evict_expired_tasks, daemon=True).start()
 
 # --- Create a directory for saved translations ---
 OUTPUT_DIR = "translated_files"
@@ -22,75 +75,166 @@ os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 # --- Translator Initialization ---
 print("Initializing the translator...")
-translator = OfflineTranslator()
+# torch.compile is opt-in (TRANSLATOR_COMPILE=1) since it slows startup considerably
+translator = OfflineTranslator(compile_model=os.environ.get("TRANSLATOR_COMPILE") == "1")
 print("Translator ready.")
 
 
+# --- Batch Dispatch: a single worker thread owns the model ---
+# Requests enqueue (job, line_index, text, direction) items; the worker drains
+# whatever is ready (across all requests) into one batched translate call.
+MAX_BATCH_LINES = 64
+translation_queue = queue.Queue()
+
+def deliver_translations(group: list):
+    """Translates one batch of queued items and writes the results back to their jobs."""
+    translations = translator.translate_batch([text for _, _, text, _ in group],
+                                              direction=group[0][3], show_progress=False)
+    for (job, idx, _, _), translation in zip(group, translations):
+        job['translated_lines'][idx] = translation
+        job['pending'] -= 1
+        if job['pending'] == 0:
+            job['done'].set()
+
+def fail_job(job: dict, error: BaseException):
+    job['error'] = error
+    job['done'].set()
+
+def batch_dispatch_worker():
+    while True:
+        items = [translation_queue.get()]
+        while len(items) < MAX_BATCH_LINES:
+            try:
+                items.append(translation_queue.get(timeout=0.005))
+            except queue.Empty:
+                break
+
+        # Lines of jobs that already failed are dropped instead of translated
+        by_direction = {}
+        for item in items:
+            if item[0]['error'] is None:
+                by_direction.setdefault(item[3], []).append(item)
+
+        for group in by_direction.values():
+            by_job = {}
+            for item in group:
+                by_job.setdefault(id(item[0]), []).append(item)
+            try:
+                deliver_translations(group)
+            except BaseException as e:
+                # BaseException too: load_model's sys.exit must not kill this thread
+                if len(by_job) == 1:
+                    fail_job(group[0][0], e)
+                    continue
+                # The batch mixes requests: retry each job on its own so only
+                # the job that actually fails gets the error
+                for job_items in by_job.values():
+                    try:
+                        deliver_translations(job_items)
+                    except BaseException as job_error:
+                        fail_job(job_items[0][0], job_error)
+
+dispatch_thread = threading.Thread(target=batch_dispatch_worker, daemon=True)
+dispatch_thread.start()
+
+
 # --- Helper Functions (mostly unchanged) ---
 def extract_pdf_lines(pdf_file_path: str) -> list:
     lines = []
     try:
-        with open(pdf_file_path, 'rb') as f:
-            reader = PyPDF2.PdfReader(f)
-            for page in reader.pages:
-                text = page.extract_text()
-                if text:
-                    lines.extend(text.splitlines())
+        for text in extract_pdf_pages(pdf_file_path):
+            if text:
+                lines.extend(text.splitlines())
     except Exception as e:
         print(f"Error extracting PDF text: {e}")
         return []
     return lines
 
 def translate_lines(lines: list, direction: str | None) -> list:
-    return [
-        translator.translate_text(line, direction=direction) if line.strip() else ""
-        for line in lines
-    ]
+    # Detect once for the whole document so lines are never detected one by one
+    if not direction:
+        direction = translator.detect_direction(lines)
+    job = {
+        'translated_lines': [""] * len(lines),
+        'pending': 0,
+        'done': threading.Event(),
+        'error': None
+    }
+    items = [(job, idx, line, direction) for idx, line in enumerate(lines) if line.strip()]
+    job['pending'] = len(items)
+    if not items:
+        return job['translated_lines']
+    for item in items:
+        translation_queue.put(item)
+    while not job['done'].wait(timeout=1.0):
+        if not dispatch_thread.is_alive():
+            raise RuntimeError("Translation worker is not running.")
+    if job['error']:
+        raise RuntimeError(f"Translation failed: {job['error']!r}") from job['error']
+    return job['translated_lines']
 
 def count_words(lines: list) -> int:
-    return sum(len(line.split()) for line in lines if line.strip())
+    # One C-level split over the joined text instead of a split per line
+    return len(" ".join(lines).split())
 
 # --- NEW: Background Task Function ---
-def run_translation_task(task_id: str, pdf_path: str, original_filename: str, direction: str | None):
-    """This function runs in a separate thread and performs the heavy lifting."""
+# Lines translated and written to disk per step of a PDF task
+TASK_BATCH_LINES = 256
+
+# Bounded pools instead of a thread per upload. Extraction gets one worker
+# because PDFIUM_LOCK serializes it anyway. Several PDF jobs translate at once
+# so a short upload isn't stuck behind a long one: the batch dispatch thread
+# still owns the model and mixes their lines into shared batches.
+EXTRACTION_POOL = ThreadPoolExecutor(max_workers=1)
+TRANSLATION_POOL = ThreadPoolExecutor(max_workers=4)
+
+def extract_and_remove_pdf(pdf_path: str) -> list:
+    """Extracts the PDF's lines on the extraction pool and deletes the temporary upload."""
+    try:
+        return extract_pdf_lines(pdf_path)
+    finally:
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+
+def run_translation_task(task_id: str, extract_future, direction: str | None):
+    """This function runs on the translation pool and performs the heavy lifting."""
+    # Named after the task, not the upload, so same-named uploads never collide
+    output_path = os.path.join(OUTPUT_DIR, f"{task_id}.txt")
     try:
         # Update status to 'processing'
-        tasks[task_id]['status'] = 'processing'
+        update_task(task_id, status='processing', output_file=output_path)
         
-        # 1. Extract text from PDF
-        original_lines = extract_pdf_lines(pdf_path)
+        # 1. Wait for the text extracted from the PDF
+        original_lines = extract_future.result()
         if not original_lines:
             raise ValueError("Could not extract text from PDF.")
+        if not direction:
+            direction = translator.detect_direction(original_lines)
             
-        # 2. Translate the text
-        translated_lines = translate_lines(original_lines, direction)
-        
-        # 3. Save the translated output to a file
-        output_filename = f"{os.path.splitext(original_filename)[0]}_translated.txt"
-        output_path = os.path.join(OUTPUT_DIR, output_filename)
+        # 2. Translate in batches, appending each one to the output file as it
+        #    finishes so the full translation is never held in memory
+        word_count_translated = 0
         with open(output_path, 'w', encoding='utf-8') as f:
-            f.write("\n".join(translated_lines))
+            for start in range(0, len(original_lines), TASK_BATCH_LINES):
+                translated_batch = translate_lines(original_lines[start:start + TASK_BATCH_LINES], direction)
+                f.write("\n".join(translated_batch) + "\n")
+                f.flush()
+                word_count_translated += count_words(translated_batch)
+                update_task(task_id, lines_done=start + len(translated_batch))
             
-        # 4. Prepare the final result
+        # 3. Prepare the final result (the translation itself is served by /download)
         result = {
-            "original_lines": original_lines,
-            "translated_lines": translated_lines,
+            "line_count": len(original_lines),
             "word_count_original": count_words(original_lines),
-            "word_count_translated": count_words(translated_lines),
+            "word_count_translated": word_count_translated,
             "output_file": output_path
         }
         
         # Update task status to 'completed' with the result
-        tasks[task_id]['status'] = 'completed'
-        tasks[task_id]['result'] = result
+        update_task(task_id, status='completed', result=result, finished_at=time.time())
 
     except Exception as e:
-        tasks[task_id]['status'] = 'failed'
-        tasks[task_id]['error'] = str(e)
-    finally:
-        # Clean up the temporary PDF file
-        if os.path.exists(pdf_path):
-            os.remove(pdf_path)
+        update_task(task_id, status='failed', error=str(e), finished_at=time.time())
 
 
 # --- API Endpoints ---
@@ -132,15 +276,13 @@ def translate_pdf_endpoint_async():
     task_id = str(uuid.uuid4())
     direction = request.form.get('direction')
     
-    # Store initial task info
-    tasks[task_id] = {'status': 'pending'}
+    # Store initial task info; the upload's name is only used for the download
+    download_name = f"{os.path.splitext(secure_filename(file.filename))[0] or 'document'}_translated.txt"
+    create_task(task_id, download_name=download_name)
     
-    # Start the translation in a background thread
-    thread = threading.Thread(
-        target=run_translation_task,
-        args=(task_id, tmp_pdf_path, file.filename, direction)
-    )
-    thread.start()
+    # Extract on the extraction pool, then translate on the translation pool
+    extract_future = EXTRACTION_POOL.submit(extract_and_remove_pdf, tmp_pdf_path)
+    TRANSLATION_POOL.submit(run_translation_task, task_id, extract_future, direction)
     
     # Immediately return a response to the client
     return jsonify({
@@ -155,20 +297,39 @@ def get_status(task_id):
     """
     NEW: This endpoint lets you check the status of a background job.
     """
-    task = tasks.get(task_id)
+    task = get_task(task_id)
     if not task:
         return jsonify({"error": "Task not found."}), 404
         
     response = {"task_id": task_id, "status": task.get('status')}
     
-    if task.get('status') == 'completed':
+    if task.get('status') == 'processing' and 'lines_done' in task:
+        response['lines_done'] = task['lines_done']
+    elif task.get('status') == 'completed':
         response['result'] = task.get('result')
+        response['download_url'] = f"/download/{task_id}"
     elif task.get('status') == 'failed':
         response['error'] = task.get('error')
         
     return jsonify(response)
 
 
+@app.route("/download/<task_id>", methods=['GET'])
+def download_translation(task_id):
+    """Serves the translated text file of a completed job."""
+    task = get_task(task_id)
+    if not task:
+        return jsonify({"error": "Task not found."}), 404
+    if task.get('status') != 'completed':
+        return jsonify({"error": "Translation is not completed yet."}), 409
+    try:
+        return send_file(os.path.abspath(task['output_file']), mimetype='text/plain; charset=utf-8',
+                         as_attachment=True, download_name=task['download_name'])
+    except FileNotFoundError:
+        # Evicted (and its file deleted) after we looked the task up
+        return jsonify({"error": "Task not found."}), 404
+
+
 # --- To run the app directly ---
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
\ No newline at end of file
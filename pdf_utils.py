@@ -0,0 +1,30 @@
+"""
+PDF text extraction helpers built on pypdfium2.
+"""
+
+import threading
+from typing import List
+
+import pypdfium2 as pdfium
+
+# PDFium is not thread-safe and pypdfium2 does no locking of its own, so every
+# PDFium call in this process goes through this lock
+PDFIUM_LOCK = threading.Lock()
+
+
+def extract_pdf_pages(pdf_path: str) -> List[str]:
+    """Extract the text of every page, in order."""
+    # Extraction runs in native code and is fast; it is serialized rather than
+    # forked into worker processes from the multi-threaded server
+    page_texts = []
+    with PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(pdf_path)
+        try:
+            for page in pdf:
+                textpage = page.get_textpage()
+                page_texts.append(textpage.get_text_range())
+                textpage.close()
+                page.close()
+        finally:
+            pdf.close()
+    return page_texts
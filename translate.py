@@ -7,22 +7,89 @@ Supports very long documents with efficient chunking and reassembly.
 import argparse
 import os
 import sys
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple
+import numpy as np
 import torch
 from transformers import MarianMTModel, MarianTokenizer
 from tqdm import tqdm
 import re
-import PyPDF2
+from pdf_utils import extract_pdf_pages
+
+try:
+    import ctranslate2
+except ImportError:
+    ctranslate2 = None
 
 # Set a custom HuggingFace cache directory
 os.environ["HF_HOME"] = os.path.abspath("hf_cache")
 
+# CTranslate2 models converted with ct2-transformers-converter (used when present)
+CT2_MODEL_DIRS = {
+    'en2ar': os.path.abspath("ct2_en_ar"),
+    'ar2en': os.path.abspath("ct2_ar_en")
+}
+
+# Precompiled once instead of on every detect_language call
+ARABIC_CHAR_RE = re.compile(r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]')
+WHITESPACE_RE = re.compile(r'\s')
+LATIN_LETTER_RE = re.compile(r'[A-Za-z\u00C0-\u024F]')
+
+# Letters of the script each translation direction translates from
+SOURCE_SCRIPT_RE = {
+    'en2ar': LATIN_LETTER_RE,
+    'ar2en': ARABIC_CHAR_RE
+}
+
+def cpu_supports_bf16() -> bool:
+    """Check for native bf16 matmuls on the CPU (AVX512-BF16 or AMX)."""
+    checks = ('_is_avx512_bf16_supported', '_is_amx_tile_supported')
+    try:
+        return any(getattr(torch.cpu, name, lambda: False)() for name in checks)
+    except Exception:
+        return False
+
 class OfflineTranslator:
-    def __init__(self):
+    def __init__(self, cache_size: int = 10_000, encode_cache_size: int = 50_000,
+                 compile_model: bool = False, preload: bool = True):
         self.models = {}
         self.tokenizers = {}
+        # Opt-in: compiling adds minutes to startup per model, and torch.compile needs
+        # Triton/a C++ toolchain, which Windows installs usually lack
+        self.compile_model = compile_model and hasattr(torch, 'compile') and sys.platform != 'win32'
+        # LRU cache of finished translations keyed by (direction, stripped text)
+        self._cache = OrderedDict()
+        self.cache_size = cache_size
+        # LRU cache of tokenizer output keyed by (direction, text), for repeated boilerplate lines
+        self._encode_cache = OrderedDict()
+        self.encode_cache_size = encode_cache_size
+        # Inputs shorter than this many tokens are decoded greedily instead of with beam=5
+        self.beam_threshold = 12
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        print(f"Using device: {self.device}")
+        # Half precision halves weight bandwidth for the memory-bound decode loop
+        if self.device.type == 'cuda':
+            self.dtype = torch.float16
+        elif cpu_supports_bf16():
+            self.dtype = torch.bfloat16
+        else:
+            self.dtype = torch.float32
+        print(f"Using device: {self.device} ({self.dtype})")
+        
+        if self.device.type == 'cpu':
+            # Let intra-op kernels use every core and avoid nested inter-op pools
+            torch.set_num_threads(os.cpu_count() or 1)
+            try:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
+                pass  # Already fixed once any parallel work has run
+        
+        if preload:
+            # Load both directions concurrently so downloads and disk reads overlap
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [executor.submit(self.load_model, d) for d in ('en2ar', 'ar2en')]
+                for future in futures:
+                    future.result()
         
     def load_model(self, direction: str):
         """Load the appropriate model for the translation direction."""
@@ -44,8 +111,23 @@ class OfflineTranslator:
         
         try:
             tokenizer = MarianTokenizer.from_pretrained(model_name)
-            model = MarianMTModel.from_pretrained(model_name)
-            model.to(self.device)
+            ct2_dir = CT2_MODEL_DIRS[direction]
+            if ctranslate2 is not None and os.path.isdir(ct2_dir):
+                # Fused int8/float16 runtime, much faster than eager PyTorch
+                print(f"Using CTranslate2 model from: {ct2_dir}")
+                model = ctranslate2.Translator(
+                    ct2_dir,
+                    device=self.device.type,
+                    compute_type='float16' if self.device.type == 'cuda' else 'int8',
+                    inter_threads=1,
+                    intra_threads=os.cpu_count() or 1
+                )
+            else:
+                model = MarianMTModel.from_pretrained(model_name)
+                model.to(self.device, dtype=self.dtype)
+                model.eval()
+                if self.compile_model:
+                    self.compile_and_warm_up(model, tokenizer)
             
             self.models[direction] = model
             self.tokenizers[direction] = tokenizer
@@ -58,10 +140,24 @@ class OfflineTranslator:
             print("Make sure you have internet connection for initial model download.")
             sys.exit(1)
     
+    def compile_and_warm_up(self, model, tokenizer):
+        """JIT-compile the model forward pass and run one warm-up generate."""
+        eager_forward = model.forward
+        try:
+            # No CUDA graphs ('reduce-overhead'): the KV cache grows every decode step,
+            # so each length and batch shape would need its own graph recording
+            model.forward = torch.compile(eager_forward, mode='default', dynamic=True)
+            # With dynamic shapes one warm-up compiles the graph for all lengths
+            inputs = tokenizer("Hello world.", return_tensors="pt")
+            self.run_generate(model, inputs, max_length=16, num_beams=5)
+        except Exception as e:
+            print(f"torch.compile unavailable, using eager mode: {e}")
+            model.forward = eager_forward
+    
     def detect_language(self, text: str) -> str:
         """Simple language detection based on character sets."""
-        arabic_chars = len(re.findall(r'[\u0600-\u06FF\u0750-\u077F\u08A0-\u08FF\uFB50-\uFDFF\uFE70-\uFEFF]', text))
-        total_chars = len(re.sub(r'\s', '', text))
+        arabic_chars = len(ARABIC_CHAR_RE.findall(text))
+        total_chars = len(text) - len(WHITESPACE_RE.findall(text))
         
         if total_chars == 0:
             return 'en'  # Default to English
@@ -69,50 +165,192 @@ class OfflineTranslator:
         arabic_ratio = arabic_chars / total_chars
         return 'ar' if arabic_ratio > 0.3 else 'en'
     
+    def detect_direction(self, lines: List[str], sample_size: int = 20) -> str:
+        """Pick one translation direction for a whole document from a sample of its lines."""
+        non_empty = [line for line in lines if line.strip()]
+        # Spread the sample across the document rather than taking only its header
+        step = max(1, len(non_empty) // sample_size)
+        sample = " ".join(non_empty[::step][:sample_size])
+        return 'ar2en' if self.detect_language(sample) == 'ar' else 'en2ar'
+    
     def chunk_text(self, text: str, max_length: int = 512) -> List[str]:
         """Split long text into manageable chunks while preserving sentence boundaries."""
-        # Split by sentences first
-        sentences = re.split(r'[.!?]+', text)
+        # Split by sentences first, keeping each sentence's own delimiter
+        parts = re.split(r'([.!?]+)', text)
+        sentences = [
+            (parts[i].strip(), parts[i + 1] if i + 1 < len(parts) else "")
+            for i in range(0, len(parts), 2)
+        ]
         chunks = []
-        current_chunk = ""
+        current_parts = []
+        current_len = 0
         
-        for sentence in sentences:
-            sentence = sentence.strip()
+        for sentence, delimiter in sentences:
             if not sentence:
                 continue
+            sentence += delimiter
                 
             # If adding this sentence would exceed max_length, start a new chunk
-            if len(current_chunk) + len(sentence) > max_length and current_chunk:
-                chunks.append(current_chunk.strip())
-                current_chunk = sentence
-            else:
-                if current_chunk:
-                    current_chunk += ". " + sentence
-                else:
-                    current_chunk = sentence
+            if current_len + len(sentence) > max_length and current_parts:
+                chunks.append(" ".join(current_parts))
+                current_parts = []
+                current_len = 0
+            current_parts.append(sentence)
+            current_len += len(sentence) + 1
         
         # Add the last chunk if it exists
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        if current_parts:
+            chunks.append(" ".join(current_parts))
         
         return chunks if chunks else [text]
     
-    def translate_chunk(self, text: str, model, tokenizer) -> str:
-        """Translate a single chunk of text."""
-        if not text.strip():
-            return ""
-        
-        # Tokenize
-        inputs = tokenizer(text, return_tensors="pt", padding=True, truncation=True, max_length=512)
+    def run_generate(self, model, inputs, **generate_kwargs):
+        """Call model.generate on the model's device under no_grad and autocast."""
+        # Token ids stay int64; only floating point activations are autocast
         inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        with torch.no_grad(), torch.autocast(device_type=self.device.type, dtype=self.dtype,
+                                             enabled=self.dtype != torch.float32):
+            return model.generate(**inputs, **generate_kwargs)
+    
+    def num_beams_for(self, input_len: int) -> int:
+        """Use greedy decoding for short inputs and beam search for longer ones."""
+        return 1 if input_len < self.beam_threshold else 5
+    
+    def sentencepiece_encode(self, tokenizer, texts: List[str]) -> List[Tuple[int, ...]]:
+        """Encode many texts with one SentencePiece call, matching MarianTokenizer's output."""
+        # Marian has no Rust "fast" tokenizer, so call its C++ SentencePiece model directly;
+        # texts containing special-token strings keep the regular tokenizer path
+        special_tokens = tokenizer.all_special_tokens
+        plain = [i for i, text in enumerate(texts) if not any(tok in text for tok in special_tokens)]
+        plain_set = set(plain)
+        results = [
+            None if i in plain_set else tuple(tokenizer(text, truncation=True, max_length=512).input_ids)
+            for i, text in enumerate(texts)
+        ]
+        if not plain:
+            return results
+        
+        codes, bodies = zip(*(tokenizer.remove_language_code(texts[i]) for i in plain))
+        pieces = tokenizer.spm_source.encode(list(bodies), out_type=str)
+        unk_id = tokenizer.encoder[tokenizer.unk_token]
+        for i, code, text_pieces in zip(plain, codes, pieces):
+            ids = [tokenizer.encoder.get(piece, unk_id) for piece in code + text_pieces]
+            # Truncate to 512 including the trailing </s>, as tokenizer(..., max_length=512) does
+            results[i] = tuple(ids[:511]) + (tokenizer.eos_token_id,)
+        return results
+    
+    def encode_batch(self, direction: str, texts: List[str]) -> List[Tuple[int, ...]]:
+        """Tokenize texts into input ids, batch-encoding only those not already cached."""
+        results = [self._cache_get(self._encode_cache, (direction, text)) for text in texts]
+        missing = [i for i, ids in enumerate(results) if ids is None]
+        if missing:
+            encoded = self.sentencepiece_encode(self.tokenizers[direction], [texts[i] for i in missing])
+            for i, ids in zip(missing, encoded):
+                self._cache_put(self._encode_cache, (direction, texts[i]), ids, self.encode_cache_size)
+                results[i] = ids
+        return results
+    
+    def generate_batch(self, batch_ids: List[Tuple[int, ...]], model, tokenizer, num_beams: int = 5) -> List[str]:
+        """Run one batched generation on either a CTranslate2 or a MarianMT model."""
+        # Outputs rarely run past twice the source length, so don't allow 512 decode steps
+        max_length = min(512, max(16, 2 * max(len(ids) for ids in batch_ids)))
+        
+        if ctranslate2 is not None and isinstance(model, ctranslate2.Translator):
+            source_tokens = [tokenizer.convert_ids_to_tokens(list(ids)) for ids in batch_ids]
+            results = model.translate_batch(source_tokens, beam_size=num_beams, max_decoding_length=max_length)
+            return [
+                tokenizer.decode(tokenizer.convert_tokens_to_ids(result.hypotheses[0]), skip_special_tokens=True)
+                for result in results
+            ]
+        
+        # Pad only up to the longest input in this batch
+        inputs = tokenizer.pad({'input_ids': [list(ids) for ids in batch_ids]}, return_tensors="pt")
         
         # Generate translation
-        with torch.no_grad():
-            outputs = model.generate(**inputs, max_length=512, num_beams=5, early_stopping=True)
+        # Keep the KV cache on explicitly; early_stopping=True ends beam search as soon
+        # as num_beams hypotheses are finished instead of running on heuristically
+        outputs = self.run_generate(model, inputs, max_length=max_length, num_beams=num_beams,
+                                    do_sample=False, use_cache=True, early_stopping=num_beams > 1,
+                                    length_penalty=1.0, no_repeat_ngram_size=0)
         
         # Decode
-        translation = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        return translation
+        return tokenizer.batch_decode(outputs, skip_special_tokens=True)
+    
+    def _cache_get(self, cache: OrderedDict, key: Tuple[str, str]):
+        """Return a cached value (marking it recently used) or None."""
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        return None
+    
+    def _cache_put(self, cache: OrderedDict, key: Tuple[str, str], value, max_size: int):
+        """Store a value, evicting the least recently used entries."""
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+    
+    def translate_batch(self, texts: List[str], direction: str = None, batch_size: int = 32,
+                        show_progress: bool = True) -> List[str]:
+        """Translate many texts with batched generation, preserving input order."""
+        results = [""] * len(texts)
+        # Translations of each text's chunks, reassembled once every chunk is done
+        text_chunks = {}
+        
+        # Group the chunks of non-empty texts by direction, collapsing repeats and cache hits
+        groups = {}
+        for i, text in enumerate(texts):
+            text = text.strip()
+            if not text:
+                continue
+            text_direction = direction
+            if not text_direction:
+                text_direction = 'ar2en' if self.detect_language(text) == 'ar' else 'en2ar'
+            elif text_direction in SOURCE_SCRIPT_RE and not SOURCE_SCRIPT_RE[text_direction].search(text):
+                # No source-script letters at all, so nothing to translate
+                # (e.g. English headings in an Arabic document going to English)
+                results[i] = texts[i]
+                continue
+            
+            # Split long texts so nothing is lost to the 512-token model limit
+            chunks = self.chunk_text(text)
+            text_chunks[i] = [None] * len(chunks)
+            for j, chunk in enumerate(chunks):
+                cached = self._cache_get(self._cache, (text_direction, chunk))
+                if cached is not None:
+                    text_chunks[i][j] = cached
+                else:
+                    groups.setdefault(text_direction, {}).setdefault(chunk, []).append((i, j))
+        
+        for text_direction, positions in groups.items():
+            model, tokenizer = self.load_model(text_direction)
+            
+            # Tokenize once, then sort by length so each batch holds similar-length inputs
+            unique_chunks = list(positions)
+            encoded = self.encode_batch(text_direction, unique_chunks)
+            order = np.argsort([len(ids) for ids in encoded], kind='stable')
+            
+            # Short chunks decode greedily, long ones with beam search, in separate buckets
+            buckets = {}
+            for idx in order:
+                buckets.setdefault(self.num_beams_for(len(encoded[idx])), []).append(idx)
+            
+            for num_beams, bucket in buckets.items():
+                for start in tqdm(range(0, len(bucket), batch_size), desc="Translating",
+                                  disable=not show_progress):
+                    batch = bucket[start:start + batch_size]
+                    translations = self.generate_batch([encoded[idx] for idx in batch], model, tokenizer,
+                                                       num_beams=num_beams)
+                    for idx, translation in zip(batch, translations):
+                        chunk = unique_chunks[idx]
+                        self._cache_put(self._cache, (text_direction, chunk), translation, self.cache_size)
+                        for i, j in positions[chunk]:
+                            text_chunks[i][j] = translation
+        
+        for i, translations in text_chunks.items():
+            results[i] = " ".join(t for t in translations if t)
+        
+        return results
     
     def translate_text(self, text: str, direction: str = None) -> str:
         """Translate text with automatic direction detection if not specified."""
@@ -121,37 +359,24 @@ class OfflineTranslator:
             direction = 'ar2en' if detected_lang == 'ar' else 'en2ar'
             print(f"Detected language: {detected_lang}, using direction: {direction}")
         
-        # Load model
-        model, tokenizer = self.load_model(direction)
-        
-        # Chunk the text for long documents
-        chunks = self.chunk_text(text)
-        print(f"Processing {len(chunks)} chunks...")
-        
-        # Translate each chunk
-        translations = []
-        for i, chunk in enumerate(tqdm(chunks, desc="Translating")):
-            if chunk.strip():
-                translation = self.translate_chunk(chunk, model, tokenizer)
-                translations.append(translation)
+        key = (direction, text.strip())
+        cached = self._cache_get(self._cache, key)
+        if cached is not None:
+            return cached
         
-        # Reassemble the translated text
-        return " ".join(translations)
+        # translate_batch chunks long documents and reassembles the translation
+        translated_text = self.translate_batch([text], direction)[0]
+        self._cache_put(self._cache, key, translated_text, self.cache_size)
+        return translated_text
     
     def extract_text_from_pdf(self, pdf_path: str) -> str:
         """Extract all text from a PDF file."""
-        text = ""
         try:
-            with open(pdf_path, 'rb') as f:
-                reader = PyPDF2.PdfReader(f)
-                for page in reader.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
+            page_texts = extract_pdf_pages(pdf_path)
         except Exception as e:
             print(f"Error reading PDF: {e}")
             sys.exit(1)
-        return text
+        return "".join(page_text + "\n" for page_text in page_texts if page_text)
     
     def translate_file(self, input_file: str, output_file: str, direction: str = None):
         """Translate a file (txt or pdf) and save the result."""
@@ -195,7 +420,8 @@ def main():
     
     args = parser.parse_args()
     
-    translator = OfflineTranslator()
+    # The CLI uses a single direction, so load it on demand
+    translator = OfflineTranslator(preload=False)
     
     if args.text:
         # Direct text translation